@@ -1,10 +1,21 @@
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, ValidationError
-import google.generativeai as genai
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict
+from starlette.datastructures import Headers
+import hashlib
+import httpx
+import msgspec
 import os
+import random
 from dotenv import load_dotenv
-import json
+import orjson
 import uvicorn
+import zlib
 
 # --- Configuration ---
 load_dotenv()
@@ -13,162 +24,808 @@ gemini_api_key = os.getenv("GEMINI_API_KEY")
 if not gemini_api_key:
     raise ValueError("GEMINI_API_KEY environment variable not set.")
 
-# Configure the Gemini API
-genai.configure(api_key=gemini_api_key)
-
 # Make the model name configurable
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")  # Using gemini-pro as default
 
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com"
+GENERATE_CONTENT_PATH = f"/v1beta/models/{GEMINI_MODEL}:generateContent"
+STREAM_GENERATE_CONTENT_PATH = f"/v1beta/models/{GEMINI_MODEL}:streamGenerateContent"
+
+# Concurrent /build-outfits requests are coalesced into one Gemini call of up to
+# BATCH_MAX_SIZE wishlists, waiting at most BATCH_MAX_DELAY seconds to fill it.
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_DELAY = float(os.getenv("BATCH_MAX_DELAY", "0.1"))
+
+# At most GEMINI_MAX_INFLIGHT batch calls and GEMINI_MAX_INFLIGHT_STREAMS
+# streams run against Gemini at once per worker. Limits are per process, so
+# the effective global cap is their sum x WEB_CONCURRENCY (which defaults to
+# the CPU count); size them against the Gemini quota accordingly. A stream
+# holds its slot until it ends, including time spent waiting on our client to
+# read, so streams get their own pool and slow readers can't starve batch
+# calls. Calls rejected with 429/5xx are retried up to GEMINI_MAX_RETRIES
+# times with jittered exponential backoff starting at GEMINI_RETRY_BACKOFF
+# seconds.
+GEMINI_MAX_INFLIGHT = int(os.getenv("GEMINI_MAX_INFLIGHT", "32"))
+GEMINI_MAX_INFLIGHT_STREAMS = int(os.getenv("GEMINI_MAX_INFLIGHT_STREAMS", "16"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_RETRY_BACKOFF = float(os.getenv("GEMINI_RETRY_BACKOFF", "0.5"))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# An outfit combines at least two items; smaller wishlists are answered locally
+MIN_OUTFIT_ITEMS = 2
+
+# Outfits are cached per wishlist content, so repeat requests skip Gemini entirely
+OUTFIT_CACHE_SIZE = int(os.getenv("OUTFIT_CACHE_SIZE", "10000"))
+OUTFIT_CACHE_TTL = float(os.getenv("OUTFIT_CACHE_TTL", "3600"))
+
+# Upper bound for gzip-encoded request bodies, checked against both the
+# compressed upload and the decompressed result
+MAX_REQUEST_BODY_SIZE = int(os.getenv("MAX_REQUEST_BODY_SIZE", str(1024 * 1024)))
+
+# Streaming endpoints skip response compression: gzip buffers its output and
+# would hold streamed outfits back
+UNCOMPRESSED_PATHS = {"/build-outfits/stream"}
+
+# One shared client for the whole process, so every request reuses pooled
+# keep-alive connections (and TLS sessions) to the Gemini API instead of
+# paying a fresh handshake per call.
+gemini_client = httpx.AsyncClient(
+    base_url=GEMINI_API_BASE,
+    headers={"x-goog-api-key": gemini_api_key, "content-type": "application/json"},
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0),
+    http2=True,
+    timeout=httpx.Timeout(60.0),
+)
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_INFLIGHT)
+gemini_stream_semaphore = asyncio.Semaphore(GEMINI_MAX_INFLIGHT_STREAMS)
+
+
+class MsgspecJSONResponse(JSONResponse):
+    """
+    JSON response rendered with msgspec, so Structs serialize without a
+    jsonable_encoder pass.
+    """
+
+    def render(self, content) -> bytes:
+        return msgspec.json.encode(content)
+
+
+class StreamingAwareGZipMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware that leaves the responses of UNCOMPRESSED_PATHS untouched.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in UNCOMPRESSED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+class GZipRequestMiddleware:
+    """
+    Decompresses request bodies sent with `Content-Encoding: gzip` before
+    they reach the endpoints, so clients can upload compressed wishlists.
+
+    Bodies are inflated incrementally and rejected with 413 as soon as either
+    side exceeds `max_body_size`, so a small gzip bomb can't exhaust memory.
+    Multi-member bodies count against the same budget as a whole.
+    """
+
+    def __init__(self, app, max_body_size: int):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or Headers(scope=scope).get("content-encoding", "").lower() != "gzip":
+            await self.app(scope, receive, send)
+            return
+
+        # 16 + MAX_WBITS selects the gzip container format
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = bytearray()
+        received = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunk = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            received += len(chunk)
+            if received > self.max_body_size:
+                await self._reject(scope, receive, send, 413, "Request body is too large.")
+                return
+            try:
+                while True:
+                    # Inflate at most one byte past the limit, enough to detect overflow
+                    body += decompressor.decompress(chunk, self.max_body_size + 1 - len(body))
+                    # A gzip stream may hold several members back to back; bytes
+                    # after the end of one start the next. Anything that isn't a
+                    # valid member fails in the new decompressor
+                    if not decompressor.eof or not decompressor.unused_data:
+                        break
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            except zlib.error:
+                await self._reject(scope, receive, send, 400, "Request body is not valid gzip data.")
+                return
+            if len(body) > self.max_body_size:
+                await self._reject(scope, receive, send, 413, "Request body is too large.")
+                return
+
+        if not decompressor.eof:
+            await self._reject(scope, receive, send, 400, "Request body is not valid gzip data.")
+            return
+        body = bytes(body)
+
+        headers = [
+            (name, value) for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+        headers.append((b"content-length", str(len(body)).encode()))
+        scope = {**scope, "headers": headers}
+
+        body_sent = False
+
+        async def receive_decompressed():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, receive_decompressed, send)
+
+    @staticmethod
+    async def _reject(scope, receive, send, status_code: int, detail: str) -> None:
+        response = JSONResponse({"detail": detail}, status_code=status_code)
+        await response(scope, receive, send)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    outfit_batcher.start()
+    yield
+    await outfit_batcher.stop()
+    await gemini_client.aclose()
+
+
 app = FastAPI(
     title="Outfit Builder API",
     description="An API that uses a Gemini model to create outfits from a user's wishlist.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=MsgspecJSONResponse,
 )
+app.add_middleware(StreamingAwareGZipMiddleware, minimum_size=500, compresslevel=5)
+app.add_middleware(GZipRequestMiddleware, max_body_size=MAX_REQUEST_BODY_SIZE)
 
-# --- Pydantic Models for Input and Output Validation ---
+# --- Models for Input and Output Validation ---
 
-# Input Models (from your original code, no changes needed)
+# Input Models stay on Pydantic for FastAPI's request parsing and docs
 class WishlistItem(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=False)
+
     name: str
     description: str
     productId: str
 
 class Wishlist(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=False)
+
     items: list[WishlistItem]
 
-# Output Models (for response validation and documentation)
-class OutfitItem(BaseModel):
+# Output Models are msgspec Structs: slotted, far cheaper to allocate than
+# BaseModels, and decoded + validated straight from Gemini's JSON in one pass
+class OutfitItem(msgspec.Struct):
     name: str
     productId: str
 
-class Outfit(BaseModel):
+class Outfit(msgspec.Struct):
     outfitId: str
     items: list[OutfitItem]
 
-class OutfitsResponse(BaseModel):
+class OutfitsResponse(msgspec.Struct):
+    outfits: list[Outfit]
+
+# Batched Gemini output: one entry per wishlist, tagged with its index in the batch
+class UserOutfits(msgspec.Struct):
+    user: int
     outfits: list[Outfit]
 
+class BatchOutfitsResponse(msgspec.Struct):
+    results: list[UserOutfits]
 
-# --- Core Logic ---
 
-async def ask_gemini(wishlist_items: list[WishlistItem]) -> str:
+# The parts of Gemini's generateContent envelope we read; other fields are ignored
+class GeminiPart(msgspec.Struct):
+    text: str = ""
+
+class GeminiContent(msgspec.Struct):
+    parts: list[GeminiPart] = []
+
+class GeminiCandidate(msgspec.Struct):
+    content: GeminiContent = msgspec.field(default_factory=GeminiContent)
+    finishReason: str | None = None
+
+class GeminiPromptFeedback(msgspec.Struct):
+    blockReason: str | None = None
+
+class GeminiResponse(msgspec.Struct):
+    candidates: list[GeminiCandidate] = []
+    promptFeedback: GeminiPromptFeedback | None = None
+
+
+gemini_response_decoder = msgspec.json.Decoder(GeminiResponse)
+batch_response_decoder = msgspec.json.Decoder(BatchOutfitsResponse)
+outfit_decoder = msgspec.json.Decoder(Outfit)
+
+
+def inline_schema_refs(schema: dict, defs: dict | None = None) -> dict:
     """
-    Constructs a detailed prompt and sends it to the Gemini API.
+    Resolves every $ref in a JSON schema against its $defs, returning a
+    self-contained schema.
     """
-    # Convert Pydantic models to a simple dict list for the prompt
-    wishlist_json_str = json.dumps([item.dict() for item in wishlist_items], indent=2)
+    if defs is None:
+        defs = schema.get("$defs", {})
+    if "$ref" in schema:
+        return inline_schema_refs(defs[schema["$ref"].rsplit("/", 1)[-1]], defs)
 
-    # --- IMPROVED PROMPT ---
-    prompt = f"""
-You are an expert fashion stylist AI assistant. Your sole purpose is to create stylish and coherent outfits from a given list of clothing items.
+    inlined = {}
+    for key, value in schema.items():
+        if key == "$defs":
+            continue
+        if key == "properties":
+            inlined[key] = {name: inline_schema_refs(sub, defs) for name, sub in value.items()}
+        elif key == "items":
+            inlined[key] = inline_schema_refs(value, defs)
+        else:
+            inlined[key] = value
+    return inlined
 
-You MUST follow these rules strictly:
-1.  Analyze the provided "Wishlist" JSON data.
-2.  Create one or more complete outfits by combining items that complement each other.
-3.  Your response MUST BE a valid JSON array of outfit objects and nothing else.
-4.  Do NOT include any explanatory text, comments, markdown formatting (like ```json), or any characters before or after the JSON array.
 
-The output JSON array must conform to the following structure:
-[
-  {{
-    "outfitId": "A unique string identifier for the outfit (e.g., 'outfit_1').",
-    "items": [
-      {{
-        "name": "The name of the item from the wishlist.",
-        "productId": "The corresponding productId from the wishlist."
-      }}
-    ]
-  }}
-]
-
-Here is an example:
----
-Wishlist:
-[
-  {{
-    "name": "Classic Black T-shirt",
-    "description": "100% cotton crewneck",
-    "productId": "B-TS-001"
-  }},
-  {{
-    "name": "Slim-fit Chinos",
-    "description": "Beige color, stretch fabric",
-    "productId": "P-CH-005"
-  }}
-]
-
-Your Response:
-[
-  {{
-    "outfitId": "outfit_1",
-    "items": [
-      {{
-        "name": "Classic Black T-shirt",
-        "productId": "B-TS-001"
-      }},
-      {{
-        "name": "Slim-fit Chinos",
-        "productId": "P-CH-005"
-      }}
+def to_gemini_schema(schema: dict) -> dict:
+    """
+    Converts a self-contained JSON schema into the OpenAPI subset accepted by
+    Gemini's `responseSchema` (no titles, upper-case types).
+    """
+    converted = {}
+    for key, value in schema.items():
+        if key == "title":
+            continue
+        if key == "type":
+            converted[key] = value.upper()
+        elif key == "properties":
+            converted[key] = {name: to_gemini_schema(sub) for name, sub in value.items()}
+        elif key == "items":
+            converted[key] = to_gemini_schema(value)
+        else:
+            converted[key] = value
+    return converted
+
+
+# Used for the OpenAPI docs of /build-outfits
+OUTFITS_RESPONSE_JSON_SCHEMA = inline_schema_refs(msgspec.json.schema(OutfitsResponse))
+
+# Gemini's structured output mode guarantees the response matches this schema,
+# so the prompt no longer needs formatting rules or a worked example.
+BATCH_RESPONSE_SCHEMA = to_gemini_schema(inline_schema_refs(msgspec.json.schema(BatchOutfitsResponse)))
+OUTFITS_RESPONSE_SCHEMA = to_gemini_schema(OUTFITS_RESPONSE_JSON_SCHEMA)
+
+# Static instructions go first and never change, so every prompt shares a
+# byte-identical prefix that Gemini's implicit context caching can reuse;
+# only the wishlist JSON is appended per request.
+BATCH_PROMPT_PREFIX = (
+    "You are an expert fashion stylist. Each entry below is a separate user's wishlist. "
+    "For every user, combine items from their own wishlist into one or more stylish, coherent outfits. "
+    "Only use that user's wishlist items, copy each item's name and productId exactly, "
+    'and give every outfit a unique outfitId (e.g. "outfit_1"). '
+    "Return one result per user, tagged with their user number.\n\n"
+    "Wishlists:\n"
+)
+OUTFITS_PROMPT_PREFIX = (
+    "You are an expert fashion stylist. "
+    "Combine items from the wishlist below into one or more stylish, coherent outfits. "
+    "Only use wishlist items, copy each item's name and productId exactly, "
+    'and give every outfit a unique outfitId (e.g. "outfit_1").\n\n'
+    "Wishlist:\n"
+)
+
+
+# --- Core Logic ---
+
+def wishlist_item_dicts(items: list[WishlistItem]) -> list[dict]:
+    """
+    Converts wishlist items to plain dicts for the prompt.
+    """
+    # Attribute access is cheaper than a full (and, in Pydantic v2,
+    # deprecated) .dict() walk per item
+    return [
+        {"name": item.name, "description": item.description, "productId": item.productId}
+        for item in items
     ]
-  }}
-]
----
 
-Now, create outfits based on this wishlist:
 
-Wishlist:
-{wishlist_json_str}
+def generation_config(response_schema: dict) -> dict:
+    """
+    Builds a generationConfig asking for JSON matching `response_schema`.
+    """
+    return {
+        "temperature": 0.5,
+        "responseMimeType": "application/json",
+        "responseSchema": response_schema,
+    }
+
+
+# Built once at import rather than per request
+BATCH_GENERATION_CONFIG = generation_config(BATCH_RESPONSE_SCHEMA)
+OUTFITS_GENERATION_CONFIG = generation_config(OUTFITS_RESPONSE_SCHEMA)
+
+
+def gemini_request_body(prompt: str, config: dict) -> dict:
+    """
+    Wraps a prompt and a prebuilt generationConfig into a request body.
+    """
+    return {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": config}
+
+
+def retry_delay(attempt: int) -> float:
+    """
+    Jittered exponential backoff, so retries from concurrent requests spread out.
+    """
+    return random.uniform(0, GEMINI_RETRY_BACKOFF * 2 ** attempt)
+
+
+class GeminiResponseError(HTTPException):
+    """
+    Gemini answered, but its output is unusable (blocked prompt, truncated or
+    malformed output). Unlike transport or quota errors, this can be caused
+    by a single wishlist in a batch.
+    """
+
+
+def finish_error(finish_reason: str | None, block_reason: str | None) -> GeminiResponseError | None:
+    """
+    Returns the error to raise when Gemini did not finish its response
+    normally, or None when it stopped on its own.
+    """
+    if block_reason is None and finish_reason == "STOP":
+        return None
+    return GeminiResponseError(
+        status_code=502,
+        detail=f"Gemini did not finish its response (finishReason={finish_reason}, blockReason={block_reason})."
+    )
 
-Your Response:
-"""
+
+def gemini_error(response: httpx.Response) -> HTTPException:
+    """
+    Maps a failed Gemini response to the error returned to our own client.
+    """
+    if response.status_code == 429:
+        # Still rate limited after retrying: pass the backpressure on to the caller
+        return HTTPException(
+            status_code=503,
+            detail="Gemini API is rate limiting requests, please retry later.",
+            headers={"Retry-After": "5"},
+        )
+    return HTTPException(
+        status_code=502,
+        detail=f"Gemini API returned {response.status_code}: {response.text}"
+    )
+
+
+async def post_gemini(body: dict) -> httpx.Response:
+    """
+    Sends a generateContent request within the in-flight limit, retrying
+    rate-limit and server errors.
+    """
+    # Encoded once with orjson: compact, no \u escapes for non-ASCII text,
+    # and reused as-is by every retry
+    content = orjson.dumps(body)
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        async with gemini_semaphore:
+            response = await gemini_client.post(GENERATE_CONTENT_PATH, content=content)
+        if response.status_code not in RETRYABLE_STATUS_CODES or attempt == GEMINI_MAX_RETRIES:
+            return response
+        # Back off outside the semaphore so waiting retries don't hold a slot
+        await asyncio.sleep(retry_delay(attempt))
+
+
+async def ask_gemini(wishlists: list[list[WishlistItem]]) -> str:
+    """
+    Constructs a prompt covering one or more wishlists and sends it to the Gemini API.
+    """
+    wishlists_json_str = orjson.dumps(
+        [
+            {"user": user, "wishlist": wishlist_item_dicts(items)}
+            for user, items in enumerate(wishlists)
+        ]
+    ).decode()
+    prompt = BATCH_PROMPT_PREFIX + wishlists_json_str
 
     try:
-        model = genai.GenerativeModel(GEMINI_MODEL)
-        response = model.generate_content(prompt)
-        return response.text
+        # Awaiting the native async endpoint keeps the event loop free while
+        # Gemini is generating, so concurrent requests are not serialized.
+        response = await post_gemini(gemini_request_body(prompt, BATCH_GENERATION_CONFIG))
+        response.raise_for_status()
+        # Decode the raw bytes straight into the envelope structs
+        reply = gemini_response_decoder.decode(response.content)
+    except httpx.HTTPStatusError as e:
+        raise gemini_error(e.response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error calling Gemini API: {str(e)}")
 
+    candidate = reply.candidates[0] if reply.candidates else None
+    error = finish_error(
+        candidate.finishReason if candidate else None,
+        reply.promptFeedback.blockReason if reply.promptFeedback else None,
+    )
+    if error is not None:
+        raise error
+    return "".join(part.text for part in candidate.content.parts)
+
+
+@asynccontextmanager
+async def open_gemini_stream(wishlist_items: list[WishlistItem]) -> AsyncIterator[httpx.Response]:
+    """
+    Opens Gemini's streaming response for a single wishlist, retrying
+    rate-limit and server errors, and holds a stream slot while it is open.
+    Raises HTTPException if the stream can't be opened.
+    """
+    wishlist_json_str = orjson.dumps(wishlist_item_dicts(wishlist_items)).decode()
+    prompt = OUTFITS_PROMPT_PREFIX + wishlist_json_str
+
+    content = orjson.dumps(gemini_request_body(prompt, OUTFITS_GENERATION_CONFIG))
+
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        request = gemini_client.build_request(
+            "POST", STREAM_GENERATE_CONTENT_PATH, params={"alt": "sse"}, content=content
+        )
+        # The slot is held for the whole stream, see GEMINI_MAX_INFLIGHT_STREAMS
+        async with gemini_stream_semaphore:
+            try:
+                response = await gemini_client.send(request, stream=True)
+            except httpx.HTTPError as e:
+                raise HTTPException(status_code=500, detail=f"Error calling Gemini API: {str(e)}")
+            try:
+                if not response.is_error:
+                    yield response
+                    return
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt == GEMINI_MAX_RETRIES:
+                    await response.aread()
+                    raise gemini_error(response)
+            finally:
+                await response.aclose()
+        # Back off outside the semaphore so waiting retries don't hold a slot
+        await asyncio.sleep(retry_delay(attempt))
+
+
+async def read_gemini_stream(response: httpx.Response) -> AsyncIterator[str]:
+    """
+    Yields the response text of an open Gemini stream as it is generated.
+    Raises once the stream ends if Gemini did not finish normally (blocked
+    prompt, token limit, safety stop, ...).
+    """
+    finish_reason = None
+    block_reason = None
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        chunk = gemini_response_decoder.decode(line[len("data:"):])
+        if chunk.promptFeedback is not None and chunk.promptFeedback.blockReason:
+            block_reason = chunk.promptFeedback.blockReason
+        for candidate in chunk.candidates[:1]:
+            if candidate.finishReason:
+                finish_reason = candidate.finishReason
+            for part in candidate.content.parts:
+                yield part.text
+    error = finish_error(finish_reason, block_reason)
+    if error is not None:
+        raise error
+
+
+class OutfitStreamParser:
+    """
+    Incrementally pulls complete outfit objects out of a streamed
+    `{"outfits": [...]}` document.
+
+    A small bracket counter tracks nesting depth (ignoring brackets inside
+    strings); each object that opens at depth 3 is an outfit, and it is
+    parsed as soon as its closing brace arrives.
+    """
+
+    OUTFIT_DEPTH = 3
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._pending = ""
+        self._started = False
+
+    @property
+    def complete(self) -> bool:
+        """
+        True once the top-level document has been closed again.
+        """
+        return self._started and self._depth == 0 and not self._in_string
+
+    def feed(self, text: str) -> list[Outfit]:
+        outfits = []
+        start = 0 if self._depth >= self.OUTFIT_DEPTH else None
+        for i, char in enumerate(text):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._started = True
+                self._depth += 1
+                if self._depth == self.OUTFIT_DEPTH:
+                    start = i
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == self.OUTFIT_DEPTH - 1 and start is not None:
+                    outfits.append(outfit_decoder.decode(self._pending + text[start:i + 1]))
+                    self._pending = ""
+                    start = None
+        if start is not None:
+            self._pending += text[start:]
+        return outfits
+
+
+def filter_to_wishlist(outfits: list[Outfit], items: list[WishlistItem]) -> list[Outfit]:
+    """
+    Rebuilds outfits from the caller's own wishlist: items whose productId is
+    not in `items` are dropped, names come from `items` rather than Gemini's
+    output, and outfits left with too few items are dropped.
+    """
+    # Gemini's text was generated from a prompt that may hold other users'
+    # wishlists, so nothing but the productId lookup is taken from it
+    names = {item.productId: item.name for item in items}
+    filtered = []
+    for outfit in outfits:
+        own_items = [
+            OutfitItem(name=names[outfit_item.productId], productId=outfit_item.productId)
+            for outfit_item in outfit.items
+            if outfit_item.productId in names
+        ]
+        if len(own_items) >= MIN_OUTFIT_ITEMS:
+            filtered.append(Outfit(outfitId=outfit.outfitId, items=own_items))
+    return filtered
+
+
+class OutfitBatcher:
+    """
+    Coalesces concurrent wishlists into a single Gemini call.
+
+    Callers `await submit(items)`; a background task collects up to
+    `max_batch_size` wishlists or waits `max_delay` seconds, whichever comes
+    first, asks Gemini for all of them at once and hands each caller back
+    the decoded outfits for its own wishlist. A wishlist Gemini left out of
+    the results fails its caller instead of silently yielding no outfits,
+    and a batch whose output is unusable as a whole is retried one wishlist
+    at a time.
+    """
+
+    def __init__(self, max_batch_size: int, max_delay: float):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: asyncio.Task | None = None
+        self._in_flight: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        tasks = [self._worker, *self._in_flight] if self._worker else list(self._in_flight)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, items: list[WishlistItem]) -> list[Outfit]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((items, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Process the batch in its own task so the next one can start
+            # filling while this one waits on Gemini.
+            task = asyncio.create_task(self._process(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _process(self, batch: list[tuple[list[WishlistItem], asyncio.Future]]) -> None:
+        try:
+            outfits_raw_str = await ask_gemini([items for items, _ in batch])
+            results = batch_response_decoder.decode(outfits_raw_str).results
+            outfits_by_user = {result.user: result.outfits for result in results}
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            if len(batch) > 1 and isinstance(e, (GeminiResponseError, msgspec.DecodeError)):
+                # The output may have been spoiled by a single wishlist (blocked
+                # or cut off); ask for each one on its own so only that caller fails
+                await asyncio.gather(*(self._process([entry]) for entry in batch))
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for user, (items, future) in enumerate(batch):
+            if future.done():
+                continue
+            if user not in outfits_by_user:
+                future.set_exception(HTTPException(
+                    status_code=502,
+                    detail="Gemini's response did not include outfits for this wishlist."
+                ))
+                continue
+            # Several users share one prompt, so never trust Gemini to keep
+            # their items apart
+            future.set_result(filter_to_wishlist(outfits_by_user[user], items))
+
+
+outfit_batcher = OutfitBatcher(max_batch_size=BATCH_MAX_SIZE, max_delay=BATCH_MAX_DELAY)
+
+outfit_cache: TTLCache = TTLCache(maxsize=OUTFIT_CACHE_SIZE, ttl=OUTFIT_CACHE_TTL)
+
+
+def wishlist_cache_key(items: list[WishlistItem]) -> str:
+    """
+    Hashes the wishlist contents, ignoring item order, into a compact cache key.
+    """
+    canonical = sorted((item.productId, item.name, item.description) for item in items)
+    return hashlib.blake2b(orjson.dumps(canonical), digest_size=16).hexdigest()
+
 
 # --- API Endpoint ---
 
-@app.post("/build-outfits", response_model=OutfitsResponse)
+# OutfitsResponse is only used for the OpenAPI docs; returning a response
+# directly skips FastAPI's jsonable_encoder + response_model validation pass.
+@app.post(
+    "/build-outfits",
+    responses={200: {"content": {"application/json": {"schema": OUTFITS_RESPONSE_JSON_SCHEMA}}}},
+)
 async def build_outfits(wishlist: Wishlist):
     """
     Accepts a wishlist of clothing items and returns curated outfits.
     """
+    # No outfit can be built from fewer than two items, so don't ask Gemini
+    if len(wishlist.items) < MIN_OUTFIT_ITEMS:
+        return MsgspecJSONResponse(content=OutfitsResponse(outfits=[]))
+
     try:
-        # 1. Get raw string response from the model
-        outfits_raw_str = await ask_gemini(wishlist.items)
+        # 1. Serve identical wishlists straight from the cache
+        cache_key = wishlist_cache_key(wishlist.items)
+        cached_response = outfit_cache.get(cache_key)
+        if cached_response is not None:
+            return MsgspecJSONResponse(content=cached_response)
+
+        # 2. Queue the wishlist; the batcher sends it to Gemini together with
+        # any other wishlists that arrive at the same time and returns the
+        # parsed outfits for this one
+        outfits_data = await outfit_batcher.submit(wishlist.items)
 
-        # 2. Parse the JSON string into Python objects
-        # The model might still wrap the JSON in markdown, so we can try to strip it
-        clean_json_str = outfits_raw_str.strip().removeprefix("```json").removesuffix("```")
-        outfits_data = json.loads(clean_json_str)
+        # 3. The outfits were already validated while msgspec decoded them,
+        # and the batcher kept only items from this wishlist
+        response_data = OutfitsResponse(outfits=outfits_data)
 
-        # 3. Validate the data structure using our Pydantic response model
-        validated_response = OutfitsResponse(outfits=outfits_data)
-        
-        return validated_response
+        # An empty result is more likely a Gemini hiccup than a real answer;
+        # don't pin it in the cache for the whole TTL
+        if outfits_data:
+            outfit_cache[cache_key] = response_data
+        return MsgspecJSONResponse(content=response_data)
 
-    except json.JSONDecodeError:
+    except HTTPException:
+        raise
+    except msgspec.ValidationError as e:
+        # This is triggered if the JSON is valid but doesn't match our output models
         raise HTTPException(
-            status_code=500, 
-            detail="Failed to decode JSON from Gemini's response."
+            status_code=500,
+            detail=f"Gemini's JSON output does not match the required format: {e}"
         )
-    except ValidationError as e:
-        # This is triggered if the JSON is valid but doesn't match our OutfitsResponse model
+    except msgspec.DecodeError:
         raise HTTPException(
             status_code=500, 
-            detail=f"Gemini's JSON output does not match the required format: {e}"
+            detail="Failed to decode JSON from Gemini's response."
         )
     except Exception as e:
         # Catch any other potential errors (e.g., API connection issues)
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+
+@app.post("/build-outfits/stream")
+async def build_outfits_stream(wishlist: Wishlist):
+    """
+    Like /build-outfits, but streams the outfits as newline-delimited JSON,
+    each one sent as soon as Gemini has finished generating it. Errors after
+    the stream has started are reported as a final `{"error": ...}` line.
+    """
+    if len(wishlist.items) < MIN_OUTFIT_ITEMS:
+        return Response(media_type="application/x-ndjson")
+
+    cache_key = wishlist_cache_key(wishlist.items)
+    cached_response = outfit_cache.get(cache_key)
+    if cached_response is not None:
+        return Response(
+            content=b"".join(msgspec.json.encode(outfit) + b"\n" for outfit in cached_response.outfits),
+            media_type="application/x-ndjson",
+        )
+
+    async def outfit_lines():
+        async with open_gemini_stream(wishlist.items) as response:
+            # Upstream is open; hand back to the endpoint so it can start the response
+            yield b""
+
+            parser = OutfitStreamParser()
+            outfits_data = []
+            try:
+                async for text in read_gemini_stream(response):
+                    for outfit in filter_to_wishlist(parser.feed(text), wishlist.items):
+                        outfits_data.append(outfit)
+                        yield msgspec.json.encode(outfit) + b"\n"
+            except HTTPException as e:
+                yield orjson.dumps({"error": e.detail}) + b"\n"
+                return
+            except Exception as e:
+                yield orjson.dumps({"error": str(e)}) + b"\n"
+                return
+
+        # A document that never closed means the outfits sent so far are
+        # only part of the answer; report it and keep it out of the cache
+        if not parser.complete:
+            yield orjson.dumps({"error": "Gemini's response ended before the outfits were complete."}) + b"\n"
+            return
+
+        if outfits_data:
+            outfit_cache[cache_key] = OutfitsResponse(outfits=outfits_data)
+
+    # Run up to the first yield here, before any response headers are sent, so
+    # failing to open the upstream stream (rate limiting, upstream errors)
+    # surfaces as a real HTTP error with its status and Retry-After header
+    lines = outfit_lines()
+    await anext(lines)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
 if __name__ == "__main__":
     # Get the PORT from the environment variable provided by the platform (e.g., Render)
     port = int(os.environ.get("PORT", 8000))
     # '0.0.0.0' is the host that makes the app accessible from outside the container
-    uvicorn.run("server:app", host="0.0.0.0", port=port, reload=True)
\ No newline at end of file
+    # One worker per CPU by default (override with WEB_CONCURRENCY); no autoreload
+    # in production, and uvloop/httptools for a faster event loop and HTTP parser
+    workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        reload=False,
+    )